@@ -25,15 +25,30 @@ def parse_args():
     parser.add_argument('--num_hidden_layers', type=int, nargs='+', default=[40, 40])
 
     parser.add_argument('--first_order', action='store_true', default=False, help='run first-order version')
+    parser.add_argument('--truncated_inner_steps', action='store_true', default=False,
+                        help='only backprop second-order terms through the last inner-loop update (MAML)')
+    parser.add_argument('--checkpoint_inner_steps', action='store_true', default=False,
+                        help='recompute inner-loop activations during the meta-update instead of storing them (MAML)')
+
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the forward pass with torch.compile (first-order MAML only)')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='use bfloat16 mixed precision for the forward/inner-loop passes (MAML)')
 
     parser.add_argument('--maml', action='store_true', default=False, help='run MAML')
     parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='number of processes sampling meta-training tasks in the background (MAML)')
 
     # commands specific to the CelebA image completion task
     parser.add_argument('--use_ordered_pixels', action='store_true', default=False)
 
     args = parser.parse_args()
 
+    # the backward pass of a compiled graph cannot be differentiated again, so we only compile first-order MAML
+    if args.compile and not args.first_order:
+        parser.error('--compile requires --first_order')
+
     # use the GPU if available
     args.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -5,8 +5,6 @@ import copy
 import os
 import time
 
-import numpy as np
-import scipy.stats as st
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
@@ -36,9 +34,8 @@ def run(args, log_interval=5000, rerun=False):
 
     # get the task family
     if args.task == 'sine':
-        task_family_train = tasks_sine.RegressionTasksSinusoidal()
-        task_family_valid = tasks_sine.RegressionTasksSinusoidal()
-        task_family_test = tasks_sine.RegressionTasksSinusoidal()
+        # (the sine task family has no split-specific state, so all splits use the same instance)
+        task_family_train = task_family_valid = task_family_test = tasks_sine.RegressionTasksSinusoidal()
     elif args.task == 'celeba':
         task_family_train = tasks_celebA.CelebADataset('train', device=args.device)
         task_family_valid = tasks_celebA.CelebADataset('valid', device=args.device)
@@ -56,19 +53,21 @@ def run(args, log_interval=5000, rerun=False):
 
     # intitialise meta-optimiser
     # (only on shared params - context parameters are *not* registered parameters of the model)
-    meta_optimiser = optim.Adam(model.parameters(), args.lr_meta)
+    # (on the GPU, the fused implementation does the whole update step in a single kernel)
+    use_fused = args.device.type == 'cuda'
+    meta_optimiser = optim.Adam(model.parameters(), args.lr_meta, fused=use_fused, foreach=not use_fused)
 
     # initialise loggers
     logger = Logger()
-    logger.best_valid_model = copy.deepcopy(model)
+    logger.best_valid_state = utils.copy_state_dict(model)
+
+    # initialise meta-gradient (accumulated in place, and zeroed after every meta-update)
+    meta_gradient = [torch.zeros_like(param) for param in model.parameters()]
 
     # --- main training loop ---
 
     for i_iter in range(args.n_iter):
 
-        # initialise meta-gradient
-        meta_gradient = [0 for _ in range(len(model.state_dict()))]
-
         # sample tasks
         target_functions = task_family_train.sample_tasks(args.tasks_per_metaupdate)
 
@@ -82,13 +81,13 @@ def run(args, log_interval=5000, rerun=False):
             # get data for current task
             train_inputs = task_family_train.sample_inputs(args.k_meta_train, args.use_ordered_pixels).to(args.device)
 
+            # get targets (these don't change during the inner loop)
+            train_targets = target_functions[t](train_inputs)
+
             for _ in range(args.num_inner_updates):
                 # forward through model
                 train_outputs = model(train_inputs)
 
-                # get targets
-                train_targets = target_functions[t](train_inputs)
-
                 # ------------ update on current task ------------
 
                 # compute loss for current task
@@ -118,19 +117,22 @@ def run(args, log_interval=5000, rerun=False):
             # compute gradient + save for current task
             task_grad = torch.autograd.grad(loss_meta, model.parameters())
 
-            for i in range(len(task_grad)):
-                # clip the gradient
-                meta_gradient[i] += task_grad[i].detach().clamp_(-10, 10)
+            # clip the gradient and add it to the meta-gradient
+            torch._foreach_add_(meta_gradient, [g.detach().clamp_(-10, 10) for g in task_grad])
 
         # ------------ meta update ------------
 
-        # assign meta-gradient
-        for i, param in enumerate(model.parameters()):
-            param.grad = meta_gradient[i] / args.tasks_per_metaupdate
+        # assign meta-gradient (averaged in place; the parameters' gradients are the buffers themselves)
+        torch._foreach_div_(meta_gradient, args.tasks_per_metaupdate)
+        for param, grad in zip(model.parameters(), meta_gradient):
+            param.grad = grad
 
         # do update step on shared model
         meta_optimiser.step()
 
+        # reset meta-gradient
+        torch._foreach_zero_(meta_gradient)
+
         # reset context params
         model.reset_context_params()
 
@@ -139,19 +141,19 @@ def run(args, log_interval=5000, rerun=False):
         if i_iter % log_interval == 0:
 
             # evaluate on training set
-            loss_mean, loss_conf = eval_cavia(args, copy.deepcopy(model), task_family=task_family_train,
+            loss_mean, loss_conf = eval_cavia(args, model, task_family=task_family_train,
                                               num_updates=args.num_inner_updates)
             logger.train_loss.append(loss_mean)
             logger.train_conf.append(loss_conf)
 
             # evaluate on test set
-            loss_mean, loss_conf = eval_cavia(args, copy.deepcopy(model), task_family=task_family_valid,
+            loss_mean, loss_conf = eval_cavia(args, model, task_family=task_family_valid,
                                               num_updates=args.num_inner_updates)
             logger.valid_loss.append(loss_mean)
             logger.valid_conf.append(loss_conf)
 
             # evaluate on validation set
-            loss_mean, loss_conf = eval_cavia(args, copy.deepcopy(model), task_family=task_family_test,
+            loss_mean, loss_conf = eval_cavia(args, model, task_family=task_family_test,
                                               num_updates=args.num_inner_updates)
             logger.test_loss.append(loss_mean)
             logger.test_conf.append(loss_conf)
@@ -160,14 +162,16 @@ def run(args, log_interval=5000, rerun=False):
             utils.save_obj(logger, path)
 
             # save best model
-            if logger.valid_loss[-1] == np.min(logger.valid_loss):
+            if logger.valid_loss[-1] < logger.best_valid_loss:
                 print('saving best model at iter', i_iter)
-                logger.best_valid_model = copy.deepcopy(model)
+                logger.best_valid_loss = logger.valid_loss[-1]
+                logger.best_valid_state = utils.copy_state_dict(model)
 
             # visualise results
             if args.task == 'celeba':
-                task_family_train.visualise(task_family_train, task_family_test, copy.deepcopy(logger.best_valid_model),
-                                            args, i_iter)
+                best_valid_model = copy.deepcopy(model)
+                best_valid_model.load_state_dict(logger.best_valid_state)
+                task_family_train.visualise(task_family_train, task_family_test, best_valid_model, args, i_iter)
 
             # print current results
             logger.print_info(i_iter, start_time)
@@ -182,7 +186,8 @@ def eval_cavia(args, model, task_family, num_updates, n_tasks=100, return_gradno
 
     # logging
     losses = []
-    gradnorms = []
+    # (gradient norms stay on the device, so that we only sync once at the end)
+    gradnorms = torch.zeros((n_tasks, num_updates), device=args.device) if return_gradnorm else None
 
     # --- inner loop ---
 
@@ -200,7 +205,7 @@ def eval_cavia(args, model, task_family, num_updates, n_tasks=100, return_gradno
 
         # ------------ update on current task ------------
 
-        for _ in range(1, num_updates + 1):
+        for step in range(num_updates):
 
             # forward pass
             curr_outputs = model(curr_inputs)
@@ -219,18 +224,22 @@ def eval_cavia(args, model, task_family, num_updates, n_tasks=100, return_gradno
                 model.context_params = model.context_params - args.lr_inner * task_gradients
 
             # keep track of gradient norms
-            gradnorms.append(task_gradients[0].norm().item())
+            if return_gradnorm:
+                gradnorms[t, step] = task_gradients[0].detach().norm()
 
         # ------------ logging ------------
 
         # compute true loss on entire input range
         model.eval()
-        losses.append(F.mse_loss(model(input_range), target_function(input_range)).detach().item())
+        with torch.inference_mode():
+            losses.append(F.mse_loss(model(input_range), target_function(input_range)).item())
         model.train()
 
-    losses_mean = np.mean(losses)
-    losses_conf = st.t.interval(0.95, len(losses) - 1, loc=losses_mean, scale=st.sem(losses))
+    # reset context parameters (so the model is left as we got it)
+    model.reset_context_params()
+
+    losses_mean, losses_conf = utils.get_mean_and_conf(losses)
     if not return_gradnorm:
-        return losses_mean, np.mean(np.abs(losses_conf - losses_mean))
+        return losses_mean, losses_conf
     else:
-        return losses_mean, np.mean(np.abs(losses_conf - losses_mean)), np.mean(gradnorms)
+        return losses_mean, losses_conf, gradnorms.mean().item()
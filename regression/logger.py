@@ -15,7 +15,8 @@ class Logger:
         self.test_loss = []
         self.test_conf = []
 
-        self.best_valid_model = None
+        self.best_valid_loss = float('inf')
+        self.best_valid_state = None
 
     def print_info(self, iter_idx, start_time):
         print(
@@ -5,16 +5,16 @@ import copy
 import os
 import time
 
-import numpy as np
-import scipy.stats as st
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
 
 import utils
 import tasks_sine, tasks_celebA
 from logger import Logger
 from maml_model import MamlModel
+from task_loader import DevicePrefetcher, MetaTaskLoader
 
 
 def run(args, log_interval=5000, rerun=False):
@@ -38,9 +38,8 @@ def run(args, log_interval=5000, rerun=False):
 
     # get the task family
     if args.task == 'sine':
-        task_family_train = tasks_sine.RegressionTasksSinusoidal()
-        task_family_valid = tasks_sine.RegressionTasksSinusoidal()
-        task_family_test = tasks_sine.RegressionTasksSinusoidal()
+        # (the sine task family has no split-specific state, so all splits use the same instance)
+        task_family_train = task_family_valid = task_family_test = tasks_sine.RegressionTasksSinusoidal()
     elif args.task == 'celeba':
         task_family_train = tasks_celebA.CelebADataset('train', args.device)
         task_family_valid = tasks_celebA.CelebADataset('valid', args.device)
@@ -49,112 +48,76 @@ def run(args, log_interval=5000, rerun=False):
         raise NotImplementedError
 
     # initialise network
-    model_inner = MamlModel(task_family_train.num_inputs,
+    model_outer = MamlModel(task_family_train.num_inputs,
                             task_family_train.num_outputs,
                             n_weights=args.num_hidden_layers,
                             num_context_params=args.num_context_params,
                             device=args.device
                             ).to(args.device)
-    model_outer = copy.deepcopy(model_inner)
 
     # intitialise meta-optimiser
-    meta_optimiser = optim.Adam(model_outer.weights + model_outer.biases + [model_outer.task_context],
-                                args.lr_meta)
+    # (the only parameter of the model is the flat buffer that holds all weights, biases and the task context)
+    # (on the GPU, the fused implementation does the whole update step in a single kernel)
+    use_fused = args.device.type == 'cuda'
+    meta_optimiser = optim.Adam(model_outer.parameters(), args.lr_meta, fused=use_fused, foreach=not use_fused)
+
+    # compile the forward pass used during meta-training (arguments.py makes sure this is first-order MAML)
+    if args.compile:
+        model_train = torch.compile(model_outer)
+    else:
+        model_train = model_outer
 
     # initialise loggers
     logger = Logger()
-    logger.best_valid_model = copy.deepcopy(model_outer)
-
-    for i_iter in range(args.n_iter):
-
-        # copy weights of network
-        copy_weights = [w.clone() for w in model_outer.weights]
-        copy_biases = [b.clone() for b in model_outer.biases]
-        copy_context = model_outer.task_context.clone()
-
-        # get all shared parameters and initialise cumulative gradient
-        meta_gradient = [0 for _ in range(len(copy_weights + copy_biases) + 1)]
+    logger.best_valid_state = utils.copy_state_dict(model_outer)
 
-        # sample tasks
-        target_functions = task_family_train.sample_tasks(args.tasks_per_metaupdate)
+    # sample tasks and their data (stacked along a leading task dimension) in the background,
+    # and copy them to the device one meta-update ahead
+    task_loader = DevicePrefetcher(MetaTaskLoader(task_family_train, args), args.device)
 
-        for t in range(args.tasks_per_metaupdate):
+    for i_iter, (train_inputs, test_inputs, task_params) in enumerate(task_loader):
 
-            # reset network weights
-            model_inner.weights = [w.clone() for w in copy_weights]
-            model_inner.biases = [b.clone() for b in copy_biases]
-            model_inner.task_context = copy_context.clone()
+        # get targets for all tasks
+        train_targets = task_family_train.get_targets(train_inputs, task_params)
 
-            # get data for current task
-            train_inputs = task_family_train.sample_inputs(args.k_meta_train, args.use_ordered_pixels).to(args.device)
+        # initialise task-specific parameters (a view of the shared parameters for every task)
+        params = [p.expand((args.tasks_per_metaupdate,) + p.shape) for p in model_outer.get_params()]
 
-            for _ in range(args.num_inner_updates):
+        # optionally run forward and inner backward passes in bfloat16 (parameters and meta-update stay in float32)
+        with torch.autocast(device_type=args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
 
-                # make prediction using the current model
-                outputs = model_inner(train_inputs)
+            for step in range(args.num_inner_updates):
 
-                # get targets
-                targets = target_functions[t](train_inputs)
+                # only the gradient of the last step is part of the computation graph when truncating;
+                # earlier steps are then treated as first-order
+                create_graph = not args.first_order and \
+                               (not args.truncated_inner_steps or step == args.num_inner_updates - 1)
 
-                # ------------ update on current task ------------
+                # ------------ update on current tasks ------------
 
-                # compute loss for current task
-                loss_task = F.mse_loss(outputs, targets)
-
-                # compute the gradient wrt current model
-                params = [w for w in model_inner.weights] + [b for b in model_inner.biases] + [model_inner.task_context]
-                grads = torch.autograd.grad(loss_task, params, create_graph=True, retain_graph=True)
-
-                # make an update on the inner model using the current model (to build up computation graph)
-                for i in range(len(model_inner.weights)):
-                    if not args.first_order:
-                        model_inner.weights[i] = model_inner.weights[i] - args.lr_inner * grads[i]
-                    else:
-                        model_inner.weights[i] = model_inner.weights[i] - args.lr_inner * grads[i].detach()
-                for j in range(len(model_inner.biases)):
-                    if not args.first_order:
-                        model_inner.biases[j] = model_inner.biases[j] - args.lr_inner * grads[i + j + 1]
-                    else:
-                        model_inner.biases[j] = model_inner.biases[j] - args.lr_inner * grads[i + j + 1].detach()
-                if not args.first_order:
-                    model_inner.task_context = model_inner.task_context - args.lr_inner * grads[i + j + 2]
+                if args.checkpoint_inner_steps and create_graph:
+                    # don't keep this step's activations until the meta-update, recompute them during backward
+                    params = checkpoint(inner_update, model_train, params, train_inputs, train_targets, args.lr_inner,
+                                        create_graph, use_reentrant=False)
                 else:
-                    model_inner.task_context = model_inner.task_context - args.lr_inner * grads[i + j + 2].detach()
+                    params = inner_update(model_train, params, train_inputs, train_targets, args.lr_inner, create_graph)
 
-            # ------------ compute meta-gradient on test loss of current task ------------
-
-            # get test data
-            test_inputs = task_family_train.sample_inputs(args.k_meta_test, args.use_ordered_pixels).to(args.device)
+            # ------------ compute meta-gradient on test loss of current tasks ------------
 
             # get outputs after update
-            test_outputs = model_inner(test_inputs)
+            test_outputs = model_train(test_inputs, params)
 
             # get the correct targets
-            test_targets = target_functions[t](test_inputs)
+            test_targets = task_family_train.get_targets(test_inputs, task_params)
 
-            # compute loss (will backprop through inner loop)
+            # compute loss, averaged over tasks (will backprop through inner loop)
             loss_meta = F.mse_loss(test_outputs, test_targets)
 
-            # compute gradient w.r.t. *outer model*
-            task_grads = torch.autograd.grad(loss_meta,
-                                             model_outer.weights + model_outer.biases + [model_outer.task_context])
-            for i in range(len(model_inner.weights + model_inner.biases) + 1):
-                meta_gradient[i] += task_grads[i].detach()
-
         # ------------ meta update ------------
 
+        # compute meta-gradient w.r.t. *outer model*
         meta_optimiser.zero_grad()
-        # print(meta_gradient)
-
-        # assign meta-gradient
-        for i in range(len(model_outer.weights)):
-            model_outer.weights[i].grad = meta_gradient[i] / args.tasks_per_metaupdate
-            meta_gradient[i] = 0
-        for j in range(len(model_outer.biases)):
-            model_outer.biases[j].grad = meta_gradient[i + j + 1] / args.tasks_per_metaupdate
-            meta_gradient[i + j + 1] = 0
-        model_outer.task_context.grad = meta_gradient[i + j + 2] / args.tasks_per_metaupdate
-        meta_gradient[i + j + 2] = 0
+        loss_meta.backward()
 
         # do update step on outer model
         meta_optimiser.step()
@@ -163,21 +126,22 @@ def run(args, log_interval=5000, rerun=False):
 
         if i_iter % log_interval == 0:
 
-            # evaluate on training set
-            loss_mean, loss_conf = eval(args, copy.copy(model_outer), task_family=task_family_train,
-                                        num_updates=args.num_inner_updates)
+            # evaluate on training, validation and test set (all at once)
+            eval_results = eval_multi(args, model_outer,
+                                      task_families={'train': task_family_train,
+                                                     'valid': task_family_valid,
+                                                     'test': task_family_test},
+                                      num_updates=args.num_inner_updates)
+
+            loss_mean, loss_conf = eval_results['train']
             logger.train_loss.append(loss_mean)
             logger.train_conf.append(loss_conf)
 
-            # evaluate on test set
-            loss_mean, loss_conf = eval(args, copy.copy(model_outer), task_family=task_family_valid,
-                                        num_updates=args.num_inner_updates)
+            loss_mean, loss_conf = eval_results['valid']
             logger.valid_loss.append(loss_mean)
             logger.valid_conf.append(loss_conf)
 
-            # evaluate on validation set
-            loss_mean, loss_conf = eval(args, copy.copy(model_outer), task_family=task_family_test,
-                                        num_updates=args.num_inner_updates)
+            loss_mean, loss_conf = eval_results['test']
             logger.test_loss.append(loss_mean)
             logger.test_conf.append(loss_conf)
 
@@ -185,14 +149,16 @@ def run(args, log_interval=5000, rerun=False):
             utils.save_obj(logger, path)
 
             # save best model
-            if logger.valid_loss[-1] == np.min(logger.valid_loss):
+            if logger.valid_loss[-1] < logger.best_valid_loss:
                 print('saving best model at iter', i_iter)
-                logger.best_valid_model = copy.copy(model_outer)
+                logger.best_valid_loss = logger.valid_loss[-1]
+                logger.best_valid_state = utils.copy_state_dict(model_outer)
 
             # visualise results
             if args.task == 'celeba':
-                task_family_train.visualise(task_family_train, task_family_test, copy.copy(logger.best_valid_model),
-                                       args, i_iter)
+                best_valid_model = copy.deepcopy(model_outer)
+                best_valid_model.load_state_dict(logger.best_valid_state)
+                task_family_train.visualise(task_family_train, task_family_test, best_valid_model, args, i_iter)
 
             # print current results
             logger.print_info(i_iter, start_time)
@@ -201,70 +167,96 @@ def run(args, log_interval=5000, rerun=False):
     return logger
 
 
-def eval(args, model, task_family, num_updates, n_tasks=100, return_gradnorm=False):
-    # copy weights of network
-    copy_weights = [w.clone() for w in model.weights]
-    copy_biases = [b.clone() for b in model.biases]
-    copy_context = model.task_context.clone()
-
-    # get the task family (with infinite number of tasks)
-    input_range = task_family.get_input_range().to(args.device)
-
-    # logging
-    losses = []
-    gradnorms = []
-
-    # --- inner loop ---
-
-    for t in range(n_tasks):
-
-        # reset network weights
-        model.weights = [w.clone() for w in copy_weights]
-        model.biases = [b.clone() for b in copy_biases]
-        model.task_context = copy_context.clone()
-
-        # sample a task
-        target_function = task_family.sample_task()
-
-        # get data for current task
-        curr_inputs = task_family.sample_inputs(args.k_shot_eval, args.use_ordered_pixels).to(args.device)
-        curr_targets = target_function(curr_inputs)
-
-        # ------------ update on current task ------------
-
-        for _ in range(1, num_updates + 1):
-
-            curr_outputs = model(curr_inputs)
-
-            # compute loss for current task
-            task_loss = F.mse_loss(curr_outputs, curr_targets)
-
-            # update task parameters
-            params = [w for w in model.weights] + [b for b in model.biases] + [model.task_context]
-            grads = torch.autograd.grad(task_loss, params)
-
-            gradnorms.append(np.mean(np.array([g.norm().item() for g in grads])))
-
-            for i in range(len(model.weights)):
-                model.weights[i] = model.weights[i] - args.lr_inner * grads[i].detach()
-            for j in range(len(model.biases)):
-                model.biases[j] = model.biases[j] - args.lr_inner * grads[i + j + 1].detach()
-            model.task_context = model.task_context - args.lr_inner * grads[i + j + 2].detach()
-
-        # ------------ logging ------------
-
-        # compute true loss on entire input range
-        losses.append(F.mse_loss(model(input_range), target_function(input_range)).detach().item())
-
-    # reset network weights
-    model.weights = [w.clone() for w in copy_weights]
-    model.biases = [b.clone() for b in copy_biases]
-    model.task_context = copy_context.clone()
-
-    losses_mean = np.mean(losses)
-    losses_conf = st.t.interval(0.95, len(losses) - 1, loc=losses_mean, scale=st.sem(losses))
-
-    if not return_gradnorm:
-        return losses_mean, np.mean(np.abs(losses_conf - losses_mean))
-    else:
-        return losses_mean, np.mean(np.abs(losses_conf - losses_mean)), np.mean(gradnorms)
+def inner_update(model, params, inputs, targets, lr_inner, create_graph):
+    """
+    Makes one gradient step on the task-specific parameters of a batch of tasks.
+    """
+
+    # make prediction using the current parameters (for all tasks at once)
+    outputs = model(inputs, params)
+
+    # compute loss as sum over tasks, so that each task's parameters get the gradient of that task's loss
+    loss_task = F.mse_loss(outputs, targets, reduction='none').mean(dim=(1, 2)).sum()
+
+    # compute the gradient wrt the current parameters
+    grads = torch.autograd.grad(loss_task, params, create_graph=create_graph)
+
+    # make an update on the task-specific parameters (to build up computation graph);
+    # a single multi-tensor op updates all parameters at once
+    return torch._foreach_sub(params, grads, alpha=lr_inner)
+
+
+def eval_multi(args, model, task_families, num_updates, n_tasks=100, return_gradnorm=False):
+    """
+    Evaluates the model on n_tasks tasks from each of the given task families
+    (the tasks of all families are adapted together, as one batch).
+    :param task_families:   dict of task families, e.g. {'train': ..., 'valid': ..., 'test': ...}
+    :return:                dict with (loss mean, loss confidence[, mean gradient norm]) per task family
+    """
+
+    # sample tasks and data for all task families (stacked along a leading task dimension)
+    curr_inputs = []
+    curr_targets = []
+    range_inputs = []
+    range_targets = []
+    for task_family in task_families.values():
+        task_params = task_family.sample_task_params(n_tasks, device=args.device)
+        inputs = task_family.sample_inputs_batch(n_tasks, args.k_shot_eval, args.use_ordered_pixels,
+                                                 device=args.device)
+        curr_inputs.append(inputs)
+        curr_targets.append(task_family.get_targets(inputs, task_params))
+        # the entire input range of the task family (the same for all tasks)
+        input_range = task_family.get_input_range().to(args.device)
+        input_range = input_range.expand((n_tasks,) + input_range.shape)
+        range_inputs.append(input_range)
+        range_targets.append(task_family.get_targets(input_range, task_params))
+    curr_inputs = torch.cat(curr_inputs)
+    curr_targets = torch.cat(curr_targets)
+    num_tasks = curr_inputs.shape[0]
+
+    # (gradient norms stay on the device, so that we only sync once at the end)
+    gradnorms = torch.zeros((num_tasks, num_updates), device=args.device) if return_gradnorm else None
+
+    # initialise task-specific parameters (a view of the shared parameters for every task;
+    # the model itself is never modified)
+    params = [p.expand((num_tasks,) + p.shape) for p in model.get_params()]
+
+    # ------------ update on current tasks ------------
+
+    for step in range(num_updates):
+
+        curr_outputs = model(curr_inputs, params)
+
+        # compute loss as sum over tasks, so that each task's parameters get the gradient of that task's loss
+        task_loss = F.mse_loss(curr_outputs, curr_targets, reduction='none').mean(dim=(1, 2)).sum()
+
+        # update task parameters
+        grads = torch.autograd.grad(task_loss, params)
+
+        if return_gradnorm:
+            # per task, the mean over the parameters' gradient norms
+            gradnorms[:, step] = torch.stack([g.flatten(start_dim=1).norm(dim=1) for g in grads]).mean(dim=0)
+
+        params = torch._foreach_sub(params, grads, alpha=args.lr_inner)
+
+    # ------------ logging ------------
+
+    # compute true loss on entire input range (no autograd bookkeeping needed)
+    with torch.inference_mode():
+        losses = []
+        for i, (inputs, targets) in enumerate(zip(range_inputs, range_targets)):
+            family_params = [p[i * n_tasks:(i + 1) * n_tasks] for p in params]
+            losses.append(F.mse_loss(model(inputs, family_params), targets, reduction='none').mean(dim=(1, 2)))
+        losses = torch.cat(losses).double().cpu().numpy()
+    if return_gradnorm:
+        gradnorms = gradnorms.mean(dim=1).double().cpu().numpy()
+
+    results = {}
+    for i, name in enumerate(task_families.keys()):
+        losses_mean, losses_conf = utils.get_mean_and_conf(losses[i * n_tasks:(i + 1) * n_tasks])
+        if not return_gradnorm:
+            results[name] = (losses_mean, losses_conf)
+        else:
+            results[name] = (losses_mean, losses_conf, gradnorms[i * n_tasks:(i + 1) * n_tasks].mean())
+
+    return results
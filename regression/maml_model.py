@@ -24,45 +24,77 @@ class MamlModel(nn.Module):
         """
         super(MamlModel, self).__init__()
 
-        # initialise lists for biases and fully connected layers
-        self.weights = []
-        self.biases = []
-
         # add one
         self.nodes_per_layer = n_weights + [n_outputs]
 
-        # additional biases
-        self.task_context = torch.zeros(num_context_params).to(device)
-        self.task_context.requires_grad = True
-
-        # set up the shared parts of the layers
+        # shapes of the weights and biases of the layers, and of the additional biases (task context)
+        weight_shapes = []
+        bias_shapes = []
         prev_n_weight = n_inputs + num_context_params
         for i in range(len(self.nodes_per_layer)):
-            w = torch.Tensor(size=(prev_n_weight, self.nodes_per_layer[i])).to(device)
-            w.requires_grad = True
-            self.weights.append(w)
-            b = torch.Tensor(size=[self.nodes_per_layer[i]]).to(device)
-            b.requires_grad = True
-            self.biases.append(b)
+            weight_shapes.append(torch.Size((prev_n_weight, self.nodes_per_layer[i])))
+            bias_shapes.append(torch.Size([self.nodes_per_layer[i]]))
             prev_n_weight = self.nodes_per_layer[i]
+        self.shapes = weight_shapes + bias_shapes + [torch.Size([num_context_params])]
+
+        # all parameters are stored in one flat buffer; weights, biases and task context are views into it
+        self.sizes = [shape.numel() for shape in self.shapes]
+        self.flat = nn.Parameter(torch.zeros(sum(self.sizes), device=device))
 
         self._reset_parameters()
 
+    def get_params(self):
+        """
+        Returns the weights, biases and task context (in that order) as one list of views into the flat buffer.
+        """
+        return [p.view(shape) for p, shape in zip(torch.split(self.flat, self.sizes), self.shapes)]
+
+    @property
+    def weights(self):
+        return self.get_params()[:len(self.nodes_per_layer)]
+
+    @property
+    def biases(self):
+        n_layers = len(self.nodes_per_layer)
+        return self.get_params()[n_layers:2 * n_layers]
+
+    @property
+    def task_context(self):
+        return self.get_params()[-1]
+
     def _reset_parameters(self):
-        for i in range(len(self.nodes_per_layer)):
+        params = self.get_params()
+        n_layers = len(self.nodes_per_layer)
+        for i in range(n_layers):
             stdv = 1. / math.sqrt(self.nodes_per_layer[i])
-            self.weights[i].data.uniform_(-stdv, stdv)
-            self.biases[i].data.uniform_(-stdv, stdv)
+            params[i].data.uniform_(-stdv, stdv)
+            params[n_layers + i].data.uniform_(-stdv, stdv)
 
-    def forward(self, x):
+    def forward(self, x, params=None):
+        """
+        :param x:       inputs of shape [batch, n_inputs], or [n_tasks, batch, n_inputs] for a batch of tasks
+        :param params:  list of weights, biases and task context (in that order) to use instead of the model's own;
+                        for a batch of tasks, each parameter has an additional leading task dimension
+        """
+
+        # if no parameters are given, use the standard ones
+        if params is None:
+            params = self.get_params()
+        n_layers = len(self.nodes_per_layer)
+        weights, biases, task_context = params[:n_layers], params[n_layers:2 * n_layers], params[-1]
 
-        if len(self.task_context) != 0:
-            x = torch.cat((x, self.task_context.expand(x.shape[0], -1)), dim=1)
-        else:
-            x = torch.cat((x, self.task_context))
+        # (also without context parameters, so that the (empty) task context is part of the computation graph)
+        x = torch.cat((x, task_context.unsqueeze(-2).expand(x.shape[:-1] + task_context.shape[-1:])), dim=-1)
 
-        for i in range(len(self.weights) - 1):
-            x = F.relu(F.linear(x, self.weights[i].t(), self.biases[i]))
-        y = F.linear(x, self.weights[-1].t(), self.biases[-1])
+        for i in range(len(weights) - 1):
+            x = F.relu(self._linear(x, weights[i], biases[i]))
+        y = self._linear(x, weights[-1], biases[-1])
 
         return y
+
+    @staticmethod
+    def _linear(x, weight, bias):
+        if weight.dim() == 2:
+            return F.linear(x, weight.t(), bias)
+        # batch of tasks: one batched matrix multiplication over all tasks
+        return torch.baddbmm(bias.unsqueeze(1), x, weight)
@@ -0,0 +1,102 @@
+"""
+Sampling of meta-training tasks in background worker processes
+"""
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+class MetaTaskDataset(Dataset):
+    """
+    Each item holds the data of one meta-update: the training and test inputs of all tasks,
+    and the parameters that define the tasks (which the task family turns into targets, see `get_targets`).
+    Item idx is sampled from its own random state, seeded with (seed, idx), so the tasks
+    don't depend on which (or how many) worker processes sample them.
+    """
+
+    def __init__(self, task_family, n_iter, num_tasks, k_train, k_test, order_pixels, seed):
+        self.task_family = task_family
+        self.n_iter = n_iter
+        self.num_tasks = num_tasks
+        self.k_train = k_train
+        self.k_test = k_test
+        self.order_pixels = order_pixels
+        self.seed = seed
+
+    def __len__(self):
+        return self.n_iter
+
+    def __getitem__(self, idx):
+        rng = np.random.RandomState([self.seed, idx])
+        # (everything is sampled on the CPU; the loader moves it to the GPU)
+        task_params = self.task_family.sample_task_params(self.num_tasks, device='cpu', rng=rng)
+        train_inputs = self.task_family.sample_inputs_batch(self.num_tasks, self.k_train, self.order_pixels,
+                                                            device='cpu', rng=rng)
+        test_inputs = self.task_family.sample_inputs_batch(self.num_tasks, self.k_test, self.order_pixels,
+                                                           device='cpu', rng=rng)
+        return train_inputs, test_inputs, task_params
+
+
+class MetaTaskLoader(DataLoader):
+    """
+    Iterates over the data of args.n_iter meta-updates, which is sampled in background worker processes
+    (so that task sampling overlaps with the meta-update running in the main process).
+    """
+
+    def __init__(self, task_family, args):
+        dataset = MetaTaskDataset(task_family,
+                                  n_iter=args.n_iter,
+                                  num_tasks=args.tasks_per_metaupdate,
+                                  k_train=args.k_meta_train,
+                                  k_test=args.k_meta_test,
+                                  order_pixels=args.use_ordered_pixels,
+                                  seed=args.seed)
+        super(MetaTaskLoader, self).__init__(dataset,
+                                             batch_size=None,
+                                             num_workers=args.num_workers,
+                                             pin_memory=args.device.type == 'cuda',
+                                             persistent_workers=args.num_workers > 0)
+
+
+class DevicePrefetcher:
+    """
+    Wraps a loader and moves its batches (tuples of tensors) to the device.
+    On the GPU, the copy of the next batch is started on a separate CUDA stream
+    while the current batch is handed out, so that the copy overlaps with the computation on it.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield tuple(x.to(self.device) for x in batch)
+            return
+
+        copy_stream = torch.cuda.Stream(device=self.device)
+        next_batch = None
+        for batch in self.loader:
+            # start copying this batch to the GPU (the loader gives us pinned memory)
+            with torch.cuda.stream(copy_stream):
+                batch = tuple(x.to(self.device, non_blocking=True) for x in batch)
+            copied = torch.cuda.Event()
+            copied.record(copy_stream)
+            # meanwhile, hand out the previous batch
+            if next_batch is not None:
+                yield self._wait(*next_batch)
+            next_batch = batch, copied
+        if next_batch is not None:
+            yield self._wait(*next_batch)
+
+    def _wait(self, batch, copied):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(copied)
+        for x in batch:
+            # the tensors were allocated on the copy stream; don't let the allocator reuse them too early
+            x.record_stream(current_stream)
+        return batch
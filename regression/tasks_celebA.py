@@ -9,6 +9,8 @@ import torch.nn.functional as F
 from PIL import Image
 from torchvision.transforms import transforms
 
+import utils
+
 
 def ravel_index(x, y, img_size):
     x = x / img_size[1]
@@ -20,6 +22,11 @@ def unravel_index(x, y, img_size):
     return ((x - 1) * img_size[1] + y).long()
 
 
+def load_rgb_image(path):
+    # (a module-level function rather than a lambda, so that the dataset can be pickled for loader workers)
+    return Image.open(path).convert('RGB')
+
+
 class CelebADataset:
     """
     Same regression task as in Garnelo et al. 2018 (Conditional Neural Processes)
@@ -58,11 +65,14 @@ class CelebADataset:
             raise ValueError
 
         self.img_size = (32, 32, 3)
-        self.transform = transforms.Compose([lambda x: Image.open(x).convert('RGB'),
+        self.transform = transforms.Compose([load_rgb_image,
                                              transforms.Resize((self.img_size[0], self.img_size[1]), Image.LANCZOS),
                                              transforms.ToTensor(),
                                              ])
 
+        # cache for the (fixed) coordinates of all pixels
+        self._input_range = None
+
     def sample_task(self):
         """ Sampling a task means sampling an image. """
         # choose image
@@ -70,9 +80,11 @@ class CelebADataset:
         img = self.get_image(img_file)
         return self.get_target_function(img)
 
-    def get_image(self, filename):
+    def get_image(self, filename, device=None):
+        if device is None:
+            device = self.device
         img_path = os.path.join(self.imgs_root, filename)
-        img = self.transform(img_path).float().to(self.device)
+        img = self.transform(img_path).float().to(device)
         # img = img * 2 - 1
         img = img.permute(1, 2, 0)
         return img
@@ -96,6 +108,19 @@ class CelebADataset:
             target_functions.append(self.get_target_function(img))
         return target_functions
 
+    def sample_task_params(self, num_tasks, device='cpu', rng=np.random):
+        """ Samples the images of several tasks at once, returned as one [num_tasks, 32, 32, 3] tensor. """
+        image_files = rng.choice(self.image_files, num_tasks, replace=False)
+        return torch.stack([self.get_image(image_file, device) for image_file in image_files])
+
+    def get_targets(self, inputs, task_params):
+        """ Batched version of the target functions, for inputs of shape [num_tasks, batch_size, 2]. """
+        # de-normalise coordinates
+        x = (inputs[..., 0] * self.img_size[0]).long()
+        y = (inputs[..., 1] * self.img_size[1]).long()
+        task_idx = torch.arange(task_params.shape[0], device=task_params.device).unsqueeze(1)
+        return task_params[task_idx, x, y, :]
+
     def sample_inputs(self, batch_size, order_pixels):
         if order_pixels:
             flattened_indices = list(range(self.img_size[0] * self.img_size[1]))[:batch_size]
@@ -110,7 +135,28 @@ class CelebADataset:
         coordinates[:, 1] /= self.img_size[1]
         return coordinates
 
+    def sample_inputs_batch(self, num_tasks, batch_size, order_pixels, device='cpu', rng=np.random):
+        """
+        Sample inputs for several tasks at once, returned as one [num_tasks, batch_size, 2] tensor
+        :param device:  device to put the inputs on
+        :param rng:     numpy random state to sample from (defaults to the global one)
+        """
+        num_pixels = self.img_size[0] * self.img_size[1]
+        if order_pixels:
+            flattened_indices = np.tile(np.arange(num_pixels)[:batch_size], (num_tasks, 1))
+        else:
+            flattened_indices = np.stack([rng.choice(num_pixels, batch_size, replace=False)
+                                          for _ in range(num_tasks)])
+        x, y = np.unravel_index(flattened_indices, (self.img_size[0], self.img_size[1]))
+        coordinates = torch.from_numpy(np.stack((x, y), axis=-1)).float()
+        # normalise coordinates
+        coordinates[..., 0] /= self.img_size[0]
+        coordinates[..., 1] /= self.img_size[1]
+        return utils.to_device(coordinates, device)
+
     def get_input_range(self):
+        if self._input_range is not None:
+            return self._input_range
         flattened_indices = range(self.img_size[0] * self.img_size[1])
         x, y = np.unravel_index(flattened_indices, (self.img_size[0], self.img_size[1]))
         coordinates = np.vstack((x, y)).T
@@ -118,6 +164,7 @@ class CelebADataset:
         # normalise coordinates
         coordinates[:, 0] /= self.img_size[0]
         coordinates[:, 1] /= self.img_size[1]
+        self._input_range = coordinates
         return coordinates
 
     def get_labels(self):
@@ -156,16 +203,12 @@ class CelebADataset:
                     grad = torch.autograd.grad(loss, model.context_params, create_graph=not args.first_order)[0]
                     model.context_params = model.context_params - args.lr_inner * grad
             else:
+                params = model.get_params()
                 for _ in range(args.num_inner_updates):
-                    pixel_pred = model(pixel_inputs)
+                    pixel_pred = model(pixel_inputs, params)
                     loss = F.mse_loss(pixel_pred, pixel_targets)
-                    params = [w for w in model.weights] + [b for b in model.biases] + [model.task_context]
                     grads = torch.autograd.grad(loss, params)
-                    for k in range(len(model.weights)):
-                        model.weights[k] = model.weights[k] - args.lr_inner * grads[k].detach()
-                    for j in range(len(model.biases)):
-                        model.biases[j] = model.biases[j] - args.lr_inner * grads[k + j + 1].detach()
-                    model.task_context = model.task_context - args.lr_inner * grads[k + j + 2].detach()
+                    params = torch._foreach_sub(params, grads, alpha=args.lr_inner)
 
             # plot context
             plt.subplot(6, 6, (i % 6) * 6 + 1 + int(i > 5) * 3)
@@ -193,7 +236,11 @@ class CelebADataset:
             # predict
             plt.subplot(6, 6, (i % 6) * 6 + 3 + int(i > 5) * 3)
             input_range = task_family_train.get_input_range()
-            img_pred = model(input_range).view(task_family_train.img_size).cpu().detach().numpy()
+            if not args.maml:
+                img_pred = model(input_range)
+            else:
+                img_pred = model(input_range, params)
+            img_pred = img_pred.view(task_family_train.img_size).cpu().detach().numpy()
             # img_pred = (img_pred + 1) / 2
             img_pred[img_pred < 0] = 0
             img_pred[img_pred > 1] = 1
@@ -1,6 +1,8 @@
 import numpy as np
 import torch
 
+import utils
+
 
 class RegressionTasksSinusoidal:
     """
@@ -16,14 +18,30 @@ class RegressionTasksSinusoidal:
 
         self.input_range = [-5, 5]
 
+        # cache for the (fixed) evaluation inputs, per size
+        self._input_range_tensors = {}
+
     def get_input_range(self, size=100):
-        return torch.linspace(self.input_range[0], self.input_range[1], steps=size).unsqueeze(1)
+        if size not in self._input_range_tensors:
+            self._input_range_tensors[size] = torch.linspace(self.input_range[0], self.input_range[1],
+                                                             steps=size).unsqueeze(1)
+        return self._input_range_tensors[size]
 
     def sample_inputs(self, batch_size, *args, **kwargs):
         inputs = torch.rand((batch_size, self.num_inputs))
         inputs = inputs * (self.input_range[1] - self.input_range[0]) + self.input_range[0]
         return inputs
 
+    def sample_inputs_batch(self, num_tasks, batch_size, *args, device='cpu', rng=np.random, **kwargs):
+        """
+        Sample inputs for several tasks at once, returned as one [num_tasks, batch_size, num_inputs] tensor
+        :param device:  device to put the inputs on
+        :param rng:     numpy random state to sample from (defaults to the global one)
+        """
+        inputs = rng.uniform(self.input_range[0], self.input_range[1], (num_tasks, batch_size, self.num_inputs))
+        inputs = torch.from_numpy(inputs).float()
+        return utils.to_device(inputs, device)
+
     def sample_task(self):
         amplitude = np.random.uniform(self.amplitude_range[0], self.amplitude_range[1])
         phase = np.random.uniform(self.phase_range[0], self.phase_range[1])
@@ -53,6 +71,20 @@ class RegressionTasksSinusoidal:
         else:
             return target_functions
 
+    def sample_task_params(self, num_tasks, device='cpu', rng=np.random):
+        """ Samples amplitude and phase of several tasks at once, returned as one [num_tasks, 2] tensor. """
+        amplitude = rng.uniform(self.amplitude_range[0], self.amplitude_range[1], num_tasks)
+        phase = rng.uniform(self.phase_range[0], self.phase_range[1], num_tasks)
+        task_params = torch.from_numpy(np.stack((amplitude, phase), axis=1)).float()
+        return utils.to_device(task_params, device)
+
+    @staticmethod
+    def get_targets(inputs, task_params):
+        """ Batched version of the target functions, for inputs of shape [num_tasks, batch_size, 1]. """
+        amplitude = task_params[:, 0].view(-1, 1, 1)
+        phase = task_params[:, 1].view(-1, 1, 1)
+        return torch.sin(inputs - phase) * amplitude
+
     def sample_datapoints(self, batch_size):
         """
         Sample random input/output pairs (e.g. for training an orcale)
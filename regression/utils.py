@@ -1,9 +1,12 @@
+import copy
+import functools
 import hashlib
 import os
 import pickle
 import random
 
 import numpy as np
+import scipy.stats as st
 import torch
 
 
@@ -23,6 +26,36 @@ def set_seed(seed, cudnn=True):
         torch.backends.cudnn.deterministic = True
 
 
+def to_device(tensor, device):
+    """
+    Moves a CPU tensor to the given device;
+    copies to the GPU go through pinned memory, so that they don't block the host.
+    """
+    if torch.device(device).type == 'cuda':
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
+def copy_state_dict(model):
+    """ Returns a copy of the model's parameters (on the CPU), e.g. to keep track of the best model. """
+    return {name: value.detach().to('cpu', copy=True) for name, value in model.state_dict().items()}
+
+
+@functools.lru_cache()
+def t_quantile(q, dof):
+    """ Quantile of Student's t-distribution (cached, since we always evaluate on the same number of tasks). """
+    return st.t.ppf(q, dof)
+
+
+def get_mean_and_conf(values, confidence=0.95):
+    """
+    Returns the mean of the values and the half-width of its confidence interval (t-distribution).
+    """
+    values = np.asarray(values)
+    sem = values.std(ddof=1) / np.sqrt(len(values))
+    return values.mean(), t_quantile((1 + confidence) / 2, len(values) - 1) * sem
+
+
 def save_obj(obj, name):
     with open(name + '.pkl', 'wb') as f:
         pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
@@ -33,8 +66,22 @@ def load_obj(name):
         return pickle.load(f)
 
 
+# flags that only change how fast we run, not what we compute; they don't go into the hash
+SPEED_ONLY_ARGS = ('num_workers', 'compile', 'checkpoint_inner_steps')
+# flags that were added later; they only go into the hash if they're not at their default,
+# so that existing configurations keep their path
+LATER_ARGS_DEFAULTS = {'truncated_inner_steps': False, 'bf16': False}
+
+
 def get_path_from_args(args):
     """ Returns a unique hash for an argparse object. """
+    args = copy.copy(args)
+    for name in SPEED_ONLY_ARGS:
+        if hasattr(args, name):
+            delattr(args, name)
+    for name, default in LATER_ARGS_DEFAULTS.items():
+        if hasattr(args, name) and getattr(args, name) == default:
+            delattr(args, name)
     args_str = str(args)
     path = hashlib.md5(args_str.encode()).hexdigest()
     return path